@@ -18,17 +18,18 @@
 """Bi-directional asyncio.Transport implementations based on file descriptors."""
 
 import asyncio
-import collections
+import errno
 import fcntl
 import logging
 import os
-import select
+import signal
 import socket
+import stat
 import struct
 import subprocess
 import termios
 
-from typing import Any, ClassVar, Dict, Optional, Tuple
+from typing import Any, Callable, ClassVar, Dict, Optional, Tuple, Union
 
 
 logger = logging.getLogger(__name__)
@@ -36,18 +37,29 @@ logger = logging.getLogger(__name__)
 
 class _Transport(asyncio.Transport):
     BLOCK_SIZE: ClassVar[int] = 1024 * 1024
+    SMALL_WRITE_SIZE: ClassVar[int] = 4096
 
     # A transport always has a loop and a protocol
     _loop: asyncio.AbstractEventLoop
     _protocol: asyncio.BaseProtocol
 
-    _queue: Optional[collections.deque[bytes]]
+    _buf: Optional[bytearray]
+    _buf_head: int
+    _pending: bytearray
     _in_fd: int
     _out_fd: int
     _closing: bool
     _is_reading: bool
     _eof: bool
-    _eio_is_eof: bool = False
+    _debug: bool
+
+    # Our fds are made non-blocking, unless they're shared with others.  If
+    # they are (and possibly blocking), we only read once per wakeup.
+    _owns_fds: ClassVar[bool] = True
+
+    # Reads copy the data out straight away, so all transports can share a
+    # single buffer
+    _read_buffer: ClassVar[Optional[bytearray]] = None
 
     def __init__(self,
                  loop: asyncio.AbstractEventLoop,
@@ -59,9 +71,14 @@ class _Transport(asyncio.Transport):
         self._loop = loop
         self._protocol = protocol
 
+        # Checked on every read: see if anyone is listening, once
+        self._debug = logger.isEnabledFor(logging.DEBUG)
+
         logger.debug('Created transport %s for protocol %s, fds %d %d', self, protocol, in_fd, out_fd)
 
-        self._queue = None
+        self._buf = None
+        self._buf_head = 0
+        self._pending = bytearray()
         self._is_reading = False
         self._eof = False
         self._closing = False
@@ -69,21 +86,62 @@ class _Transport(asyncio.Transport):
         self._in_fd = in_fd
         self._out_fd = out_fd
 
+        if self._owns_fds:
+            for fd in {in_fd, out_fd} - {-1}:
+                os.set_blocking(fd, False)
+
         self._protocol.connection_made(self)
         self.resume_reading()
 
     def _read_ready(self):
-        logger.debug('Read ready on %s %s %d', self, self._protocol, self._in_fd)
-        try:
-            data = os.read(self._in_fd, _Transport.BLOCK_SIZE)
-        except IOError:
-            # PTY devices return EIO to mean "EOF"
-            if not self._eio_is_eof:
-                raise
-            data = b''
+        if self._debug:
+            logger.debug('Read ready on %s %s %d', self, self._protocol, self._in_fd)
+        if _Transport._read_buffer is None:
+            _Transport._read_buffer = bytearray(_Transport.BLOCK_SIZE)
+
+        # Keep reading for as long as each read fills the rest of the buffer,
+        # so that a burst of data gets handled in one wakeup.  A short read
+        # means that we've drained the fd.  Each read goes right after the
+        # previous one, and everything we got is handed to the protocol in one
+        # go.  The protocol can't pause us in the meantime, so a batch is never
+        # more than BLOCK_SIZE: anything beyond that is picked up on the next
+        # wakeup.
+        eof = False
+        with memoryview(_Transport._read_buffer) as buf:
+            end = 0
+            while end < len(buf):
+                try:
+                    n_bytes = self._read_chunk(buf[end:])
+                except BlockingIOError:
+                    break
+
+                if n_bytes == 0:
+                    eof = True
+                    break
+
+                end += n_bytes
+
+                if end < len(buf) or not self._owns_fds:
+                    break
+
+            data = bytes(buf[:end])
 
+        if data:
+            self._read_ready_data(data)
+
+        # The protocol might have closed us in response to the data
+        if eof and self._in_fd != -1:
+            self._read_ready_data(b'')
+
+    def _read_chunk(self, buf: memoryview) -> int:
+        # Replaced on instances that need to read differently
+        return os.readv(self._in_fd, (buf,))
+
+    def _read_ready_data(self, data: bytes) -> None:
+        assert isinstance(self._protocol, asyncio.Protocol)
         if data != b'':
-            logger.debug('  read %d bytes', len(data))
+            if self._debug:
+                logger.debug('  read %d bytes', len(data))
             self._protocol.data_received(data)
         else:
             logger.debug('  got EOF')
@@ -115,6 +173,7 @@ class _Transport(asyncio.Transport):
     def abort(self) -> None:
         self._closing = True
         self._close_reader()
+        self._pending.clear()
         self._remove_write_queue()
         self._protocol.connection_lost(None)
 
@@ -123,14 +182,17 @@ class _Transport(asyncio.Transport):
 
     def write_eof(self) -> None:
         assert not self._eof
+        self._flush_pending()
+        if self._closing:
+            return
         self._eof = True
-        if self._queue is None:
+        if self._buf is None:
             self._write_eof_now()
 
     def get_write_buffer_size(self) -> int:
-        if self._queue is None:
-            return 0
-        return sum(len(block) for block in self._queue)
+        if self._buf is None:
+            return len(self._pending)
+        return len(self._buf) - self._buf_head + len(self._pending)
 
     def get_write_buffer_limits(self) -> Tuple[int, int]:
         return (0, 0)
@@ -143,66 +205,141 @@ class _Transport(asyncio.Transport):
         raise NotImplementedError
 
     def _write_ready(self):
-        assert self._queue is not None
-
-        try:
-            n_bytes = os.writev(self._queue)
-        except BrokenPipeError:
-            self.abort()
-            return
-
-        while n_bytes:
-            block = self._queue.popleft()
-            if len(block) > n_bytes:
-                # This block wasn't completely written.
-                self._queue.appendleft(block[n_bytes:])
-                break
-            n_bytes -= len(block)
-        else:
-            self._remove_write_queue()
-            if self._eof:
-                self._write_eof_now()
-                self._consider_closing()
-            if self._closing:
+        # Keep writing until the kernel stops accepting data, so that we get
+        # as much out as possible per wakeup.  After a short write, the other
+        # side may well have made more room in the meantime.
+        while self._buf is not None:
+            # Data written meanwhile collects in ._pending: send it along
+            # with the rest, rather than copying it over first
+            try:
+                with memoryview(self._buf)[self._buf_head:] as data, memoryview(self._pending) as pending:
+                    if pending:
+                        n_bytes = self._sendv((data, pending))
+                    else:
+                        n_bytes = self._send(data)
+            except BlockingIOError:
+                return
+            except BrokenPipeError:
+                # NB: outside of the with block, as abort() resizes ._pending
                 self.abort()
+                return
+
+            self._write_done(n_bytes)
+
+    def _write_done(self, n_bytes: int) -> None:
+        assert self._buf is not None
+        self._buf_head += n_bytes
+
+        if self._buf_head >= len(self._buf):
+            # Done with this buffer: the one that's been filling up in the
+            # meantime is next, and this one gets reused for new data
+            self._buf_head -= len(self._buf)
+            self._buf, self._pending = self._pending, self._buf
+            self._pending.clear()
+
+            # A vectored write might have taken care of that one as well
+            if self._buf_head >= len(self._buf):
+                self._buf.clear()
+                self._remove_write_queue()
+                if self._eof:
+                    self._write_eof_now()
+                if self._closing:
+                    self.abort()
 
     def _remove_write_queue(self) -> None:
-        if self._queue is not None:
+        if self._buf is not None:
             self._protocol.resume_writing()
             self._loop.remove_writer(self._out_fd)
-            self._queue = None
-
-    def _create_write_queue(self, data: bytes) -> None:
-        assert self._queue is None
+            self._buf = None
+            self._buf_head = 0
+
+    def _create_write_queue(self, buf: bytearray, head: int) -> None:
+        # Takes ownership of buf, of which head bytes have been written
+        assert self._buf is None
+        self._buf = buf
+        self._buf_head = head
         self._loop.add_writer(self._out_fd, self._write_ready)
-        self._queue = collections.deque((data,))
         self._protocol.pause_writing()
 
+    def _queue_data(self, data: bytes) -> None:
+        assert self._buf is not None
+        # self._buf is only ever drained: new data goes to the other buffer
+        self._pending += data
+
+    def _flush_pending(self, more: bool = False) -> None:
+        # If there's a write queue, pending data goes out along with it
+        if self._pending and self._buf is None:
+            # Hand the buffer over: if the write comes up short, it becomes
+            # the write queue without being copied
+            data, self._pending = self._pending, bytearray()
+            self._write_now(data, owned=True, more=more)
+
+    def _send(self, data: Union[bytes, bytearray, memoryview], more: bool = False) -> int:
+        # more is a hint that we're about to write more data straight away
+        return os.write(self._out_fd, data)
+
+    def _sendv(self, blocks: Tuple[memoryview, ...]) -> int:
+        return os.writev(self._out_fd, blocks)
+
     def write(self, data: bytes) -> None:
         assert not self._closing
         assert not self._eof
 
-        if self._queue is not None:
-            self._queue.append(data)
+        if self._buf is not None:
+            self._queue_data(data)
+            return
+
+        if len(data) < _Transport.SMALL_WRITE_SIZE:
+            # Coalesce small writes into a single buffer.  It gets flushed at
+            # the end of this main loop iteration, by the next large write, or
+            # when the buffer gets large enough, whichever comes first.
+            if not self._pending:
+                self._loop.call_soon(self._flush_pending)
+            self._pending += data
+            if len(self._pending) >= _Transport.BLOCK_SIZE:
+                self._flush_pending()
+            return
+
+        self._flush_pending(more=True)
+        if self._closing:
+            # flushing hit a broken pipe
             return
 
+        if self._buf is not None:
+            self._queue_data(data)
+        else:
+            self._write_now(data)
+
+    def _write_now(self, data: Union[bytes, bytearray], owned: bool = False, more: bool = False) -> None:
         try:
-            n_bytes = os.write(self._out_fd, data)
+            n_bytes = self._send(data, more)
+        except BlockingIOError:
+            n_bytes = 0
         except BrokenPipeError:
             self.abort()
             return
 
         if n_bytes != len(data):
-            self._create_write_queue(data[n_bytes:])
+            if owned:
+                assert isinstance(data, bytearray)
+                self._create_write_queue(data, n_bytes)
+            else:
+                with memoryview(data) as view:
+                    self._create_write_queue(bytearray(view[n_bytes:]), 0)
 
     def close(self) -> None:
         if self._closing:
             return
 
+        self._flush_pending()
+        if self._closing:
+            # flushing hit a broken pipe
+            return
+
         self._closing = True
         self._close_reader()
 
-        if self._queue is not None:
+        if self._buf is not None:
             # abort() will be called from _write_ready() when it's done
             return
 
@@ -225,6 +362,83 @@ class SubprocessProtocol(asyncio.Protocol):
         raise NotImplementedError
 
 
+class _WaitidChildWatcher:
+    """A child watcher that asks the kernel which child exited.
+
+    SafeChildWatcher calls waitpid() on each of its children for every
+    SIGCHLD.  Instead, we peek at the next exited child with waitid(WNOWAIT)
+    and reap it only if it's one of ours.  Children spawned by others get
+    left alone: if one of them is in the way, we fall back to checking each of
+    our children individually.
+
+    This isn't an asyncio.AbstractChildWatcher: those are deprecated, and
+    we only need the part of the API that SubprocessTransport uses.
+    """
+    _loop: Optional[asyncio.AbstractEventLoop] = None
+    _callbacks: Dict[int, Tuple[Callable[..., None], Tuple[Any, ...]]]
+
+    def __init__(self) -> None:
+        self._callbacks = {}
+
+    def attach_loop(self, loop: Optional[asyncio.AbstractEventLoop]) -> None:
+        if self._loop is not None:
+            self._loop.remove_signal_handler(signal.SIGCHLD)
+
+        self._loop = loop
+
+        if loop is not None:
+            loop.add_signal_handler(signal.SIGCHLD, self._sigchld)
+            # Something might have exited before we were attached
+            self._sigchld()
+
+    def add_child_handler(self, pid: int, callback: Callable[..., None], *args: Any) -> None:
+        assert self._loop is not None
+        self._callbacks[pid] = (callback, args)
+        # The child might have exited already.  Don't call back before our
+        # caller is done setting up, though.
+        self._loop.call_soon(self._reap, pid)
+
+    def _reap(self, pid: int) -> None:
+        if pid not in self._callbacks:
+            return  # already reaped from _sigchld()
+
+        try:
+            reaped, status = os.waitpid(pid, os.WNOHANG)
+        except ChildProcessError:
+            # Someone else reaped it, so we can't know how it exited
+            logger.warning('Unknown child process pid %d, will report returncode 255', pid)
+            returncode = 255
+        else:
+            if reaped == 0:
+                return  # still running
+            returncode = os.waitstatus_to_exitcode(status)
+
+        callback, args = self._callbacks.pop(pid)
+        callback(pid, returncode, *args)
+
+    def _sigchld(self) -> None:
+        while True:
+            try:
+                info = os.waitid(os.P_ALL, 0, os.WEXITED | os.WNOHANG | os.WNOWAIT)
+            except ChildProcessError:
+                # No children at all: any that we're still waiting for got
+                # reaped by someone else
+                for pid in list(self._callbacks):
+                    self._reap(pid)
+                return
+
+            if info is None:
+                return  # no more exited children
+
+            if info.si_pid not in self._callbacks:
+                # This one isn't ours, and we can't get past it
+                for pid in list(self._callbacks):
+                    self._reap(pid)
+                return
+
+            self._reap(info.si_pid)
+
+
 class SubprocessTransport(_Transport, asyncio.SubprocessTransport):
     """A bi-directional transport speaking with stdin/out of a subprocess.
 
@@ -241,7 +455,8 @@ class SubprocessTransport(_Transport, asyncio.SubprocessTransport):
     data from it, making it available via the .get_stderr() method.
     """
 
-    _watcher: ClassVar[Optional[asyncio.AbstractChildWatcher]] = None
+    _watcher: ClassVar[Optional[_WaitidChildWatcher]] = None
+    _pidfd: Optional[int] = None
     _returncode: Optional[int] = None
 
     _pty_fd: Optional[int] = None
@@ -249,19 +464,62 @@ class SubprocessTransport(_Transport, asyncio.SubprocessTransport):
     _stderr: Optional['Spooler']
 
     @classmethod
-    def _get_watcher(cls) -> asyncio.AbstractChildWatcher:
+    def _get_watcher(cls) -> _WaitidChildWatcher:
+        # Only used if we can't get a pidfd for the process
         if cls._watcher is None:
-            if hasattr(asyncio, 'PidfdChildWatcher'):
-                try:
-                    os.close(os.pidfd_open(os.getpid(), 0))  # check for kernel support
-                    cls._watcher = asyncio.PidfdChildWatcher()
-                except OSError:
-                    pass
-            if cls._watcher is None:
-                cls._watcher = asyncio.SafeChildWatcher()
+            cls._watcher = _WaitidChildWatcher()
             cls._watcher.attach_loop(asyncio.get_running_loop())
         return cls._watcher
 
+    def _watch_process(self, loop: asyncio.AbstractEventLoop) -> None:
+        try:
+            self._pidfd = os.pidfd_open(self._process.pid)
+        except (AttributeError, OSError):
+            # os.pidfd_open() is new in Python 3.9, and in kernel 5.3
+            self._get_watcher().add_child_handler(self._process.pid, self._exited)
+        else:
+            loop.add_reader(self._pidfd, self._pidfd_ready)
+
+    def _pidfd_ready(self) -> None:
+        # The pidfd becomes readable when the process exits
+        assert self._pidfd is not None
+        self._loop.remove_reader(self._pidfd)
+        os.close(self._pidfd)
+        self._pidfd = None
+
+        pid = self._process.pid
+        try:
+            _, status = os.waitpid(pid, 0)
+        except ChildProcessError:
+            # Someone else reaped it, so we can't know how it exited
+            logger.warning('Unknown child process pid %d, will report returncode 255', pid)
+            returncode = 255
+        else:
+            returncode = os.waitstatus_to_exitcode(status)
+
+        self._exited(pid, returncode)
+
+    def abort(self) -> None:
+        super().abort()
+        # The protocol has had its chance to look at stderr in connection_lost()
+        if self._stderr is not None:
+            self._stderr.close()
+
+    def _read_pty_chunk(self, buf: memoryview) -> int:
+        # Only ask for what's there: avoids the kernel staging a full
+        # BLOCK_SIZE read for the typical few bytes of a PTY session
+        available, = struct.unpack('i', fcntl.ioctl(self._in_fd, termios.FIONREAD, b'\0\0\0\0'))
+        if 0 < available < len(buf):
+            buf = buf[:available]
+
+        try:
+            return os.readv(self._in_fd, (buf,))
+        except OSError as exc:
+            # PTY devices return EIO to mean "EOF"
+            if exc.errno == errno.EIO:
+                return 0
+            raise
+
     def get_stderr(self) -> bytes:
         if self._stderr is not None:
             return self._stderr.get()
@@ -269,9 +527,9 @@ class SubprocessTransport(_Transport, asyncio.SubprocessTransport):
             return b''
 
     def _exited(self, pid, code):
-        # NB: per AbstractChildWatcher API, this handler should be thread-safe,
-        # but we only ever use non-threaded child watcher implementations, so
-        # we can assume we'll always be called in the main thread.
+        # NB: we only ever use our own non-threaded child watcher (if any:
+        # usually we watch a pidfd ourselves), so we can assume we'll always
+        # be called in the main thread.
 
         # NB: the subprocess is going to want to waitpid() itself as well, but
         # will get ECHILD since we already reaped it.  Fortunately, since
@@ -297,7 +555,7 @@ class SubprocessTransport(_Transport, asyncio.SubprocessTransport):
             os.close(session_fd)
 
             in_fd, out_fd = self._pty_fd, self._pty_fd
-            self._eio_is_eof = True
+            self._read_chunk = self._read_pty_chunk  # type: ignore[method-assign]
 
         else:
             self._process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, **kwargs)
@@ -310,7 +568,7 @@ class SubprocessTransport(_Transport, asyncio.SubprocessTransport):
         else:
             self._stderr = None
 
-        self._get_watcher().add_child_handler(self._process.pid, self._exited)
+        self._watch_process(loop)
 
         super().__init__(loop, protocol, in_fd, out_fd)
 
@@ -348,13 +606,22 @@ class SubprocessTransport(_Transport, asyncio.SubprocessTransport):
 class SocketTransport(_Transport):
     """A Transport subclass that can wrap any socket"""
     _socket: socket.socket
+    _is_tcp: bool
 
     def __init__(self,
                  loop: asyncio.AbstractEventLoop,
                  protocol: asyncio.BaseProtocol,
                  sock: socket.socket):
-        super().__init__(loop, protocol, sock.fileno(), sock.fileno(), {'socket': sock})
         self._socket = sock
+        self._is_tcp = sock.type == socket.SOCK_STREAM and sock.family in (socket.AF_INET, socket.AF_INET6)
+        super().__init__(loop, protocol, sock.fileno(), sock.fileno(), {'socket': sock})
+
+    def _send(self, data: Union[bytes, bytearray, memoryview], more: bool = False) -> int:
+        # Let the kernel put the data we're about to send in the same segment
+        return self._socket.send(data, socket.MSG_MORE if more and self._is_tcp else 0)
+
+    def _sendv(self, blocks: Tuple[memoryview, ...]) -> int:
+        return self._socket.sendmsg(blocks)
 
     def can_write_eof(self) -> bool:
         return True
@@ -372,6 +639,10 @@ class StdioTransport(_Transport):
         - character devices (including terminals)
         - sockets
     """
+    # stdin/out are shared with whoever started us, and often with stderr:
+    # leave their flags alone
+    _owns_fds = False
+
     def __init__(self, loop: asyncio.AbstractEventLoop, protocol: asyncio.BaseProtocol):
         super().__init__(loop, protocol, 0, 1)
 
@@ -387,36 +658,64 @@ class Spooler:
 
     This makes a copy of the fd, so you don't have to worry about holding it
     open.
+
+    If the fd is a pipe, the data gets spliced into a memfd by the kernel,
+    without ever being copied to userspace until .get() is called, or the
+    Spooler is closed.
     """
+    BLOCK_SIZE: ClassVar[int] = 64 * 1024  # default pipe capacity on Linux
 
     _loop: asyncio.AbstractEventLoop
     _fd: int
+    _sink: int = -1
     _contents: list[bytes]
+    _joined: Optional[bytes]
 
     def __init__(self, loop: asyncio.AbstractEventLoop, fd: int) -> None:
         self._loop = loop
         self._fd = os.dup(fd)
+        os.set_blocking(self._fd, False)
         self._contents = []
+        self._joined = None
+
+        # os.splice() is new in Python 3.10
+        if hasattr(os, 'splice') and stat.S_ISFIFO(os.fstat(self._fd).st_mode):
+            self._sink = os.memfd_create('cockpit-spooler', os.MFD_CLOEXEC)
 
         loop.add_reader(self._fd, self._read_ready)
 
-    def _read_ready(self) -> None:
-        data = os.read(self._fd, 8192)
-        if data != b'':
-            self._contents.append(data)
+    def _read_ready(self) -> bool:
+        # Returns True if there might be more data to read
+        try:
+            if self._sink != -1:
+                n_bytes = os.splice(self._fd, self._sink, Spooler.BLOCK_SIZE, flags=os.SPLICE_F_NONBLOCK)
+            else:
+                data = os.read(self._fd, Spooler.BLOCK_SIZE)
+                n_bytes = len(data)
+        except BlockingIOError:
+            return False
+
+        if n_bytes != 0:
+            self._joined = None
+            if self._sink == -1:
+                self._contents.append(data)
+            return True
         else:
             self.close()
-
-    def _is_ready(self) -> bool:
-        if self._fd == -1:
             return False
-        return select.select([self._fd], [], [], 0) != ([], [], [])
 
     def get(self) -> bytes:
-        while self._is_ready():
-            self._read_ready()
+        while self._fd != -1 and self._read_ready():
+            pass
 
-        return b''.join(self._contents)
+        if self._joined is None:
+            if self._sink != -1:
+                self._joined = os.pread(self._sink, os.lseek(self._sink, 0, os.SEEK_END), 0)
+            else:
+                self._joined = b''.join(self._contents)
+                self._contents = [self._joined]
+
+        return self._joined
 
     def close(self):
         if self._fd != -1:
@@ -424,5 +723,11 @@ class Spooler:
             os.close(self._fd)
             self._fd = -1
 
+        if self._sink != -1:
+            # Nothing more is coming: keep what we have, and drop the memfd
+            self._contents = [self.get()]
+            os.close(self._sink)
+            self._sink = -1
+
     def __del__(self):
         self.close()
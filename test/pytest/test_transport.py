@@ -0,0 +1,291 @@
+# This file is part of Cockpit.
+#
+# Copyright (C) 2022 Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import os
+import unittest
+import unittest.mock
+
+from cockpit.transports import _Transport, Spooler, SubprocessTransport
+
+
+class Protocol(asyncio.Protocol):
+    def __init__(self, keep_open=False):
+        self.events = []
+        self.data = bytearray()
+        self.keep_open = keep_open
+        self.transport = None
+        self.lost = asyncio.Event()
+        self.exited = asyncio.Event()
+        self.resumed = asyncio.Event()
+
+    def connection_made(self, transport):
+        self.events.append('connection_made')
+        self.transport = transport
+
+    def data_received(self, data):
+        self.events.append('data_received')
+        self.data += data
+
+    def eof_received(self):
+        self.events.append('eof_received')
+        return self.keep_open
+
+    def connection_lost(self, exc):
+        self.events.append('connection_lost')
+        self.lost.set()
+
+    def pause_writing(self):
+        self.resumed.clear()
+
+    def resume_writing(self):
+        self.resumed.set()
+
+    def process_exited(self):
+        self.events.append('process_exited')
+        self.exited.set()
+
+
+class PipeTransport(_Transport):
+    def can_write_eof(self):
+        return True
+
+    def _write_eof_now(self):
+        os.close(self._out_fd)
+        self._out_fd = -1
+
+
+def fill_pipe(fd):
+    os.set_blocking(fd, False)
+    try:
+        while True:
+            os.write(fd, b'\0' * 4096)
+    except BlockingIOError:
+        pass
+
+
+def drain_pipe(fd):
+    os.set_blocking(fd, False)
+    data = bytearray()
+    try:
+        while block := os.read(fd, 65536):
+            data += block
+    except BlockingIOError:
+        pass
+    return bytes(data)
+
+
+class TestWriteQueue(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.read_fd, self.write_fd = os.pipe()
+        self.addCleanup(os.close, self.read_fd)
+        self.protocol = Protocol()
+        self.transport = PipeTransport(asyncio.get_running_loop(), self.protocol, -1, self.write_fd)
+        self.addCleanup(self.transport.abort)
+
+    async def test_queue_single_syscall(self):
+        # make sure that the writes below can't go out straight away
+        fill_pipe(self.write_fd)
+
+        self.transport.write(b'a' * 5000)
+        self.transport.write(b'b' * 10000)
+        self.transport.write(b'c' * 10000)
+        self.assertEqual(self.transport.get_write_buffer_size(), 25000)
+
+        with unittest.mock.patch('os.write', wraps=os.write) as write, \
+                unittest.mock.patch('os.writev', wraps=os.writev) as writev:
+            self.assertEqual(len(drain_pipe(self.read_fd)) % 4096, 0)
+            await asyncio.wait_for(self.protocol.resumed.wait(), 5)
+
+        # everything queued goes out together, and nothing after that
+        self.assertEqual(writev.call_count, 1)
+        self.assertEqual(write.call_count, 0)
+        self.assertEqual(self.transport.get_write_buffer_size(), 0)
+        self.assertEqual(drain_pipe(self.read_fd), b'a' * 5000 + b'b' * 10000 + b'c' * 10000)
+
+    async def test_small_writes_coalesce(self):
+        with unittest.mock.patch('os.write', wraps=os.write) as write:
+            for _ in range(100):
+                self.transport.write(b'x' * 10)
+            await asyncio.sleep(0)
+
+        self.assertEqual(write.call_count, 1)
+        self.assertEqual(drain_pipe(self.read_fd), b'x' * 1000)
+
+    async def test_write_eof_after_queue(self):
+        fill_pipe(self.write_fd)
+        self.transport.write(b'a' * 100000)
+        self.transport.write_eof()
+
+        data = bytearray()
+        while not data.endswith(b'a' * 100000):
+            await asyncio.sleep(0.01)
+            data += drain_pipe(self.read_fd)
+
+        # the write end got closed once the queue was empty
+        await asyncio.sleep(0.01)
+        self.assertEqual(os.read(self.read_fd, 1), b'')
+        self.assertEqual(self.transport.get_write_buffer_size(), 0)
+
+
+class TestRead(unittest.IsolatedAsyncioTestCase):
+    async def test_data_then_eof(self):
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, b'hello')
+        os.close(write_fd)
+
+        protocol = Protocol()
+        PipeTransport(asyncio.get_running_loop(), protocol, read_fd, -1)
+        await asyncio.wait_for(protocol.lost.wait(), 5)
+        os.close(read_fd)
+
+        self.assertEqual(protocol.data, b'hello')
+        self.assertEqual(protocol.events,
+                         ['connection_made', 'data_received', 'eof_received', 'connection_lost'])
+
+    async def test_read_batch_size(self):
+        # Use small blocks, so that a pipe can hold several of them
+        block = 16 * 1024
+        self.addCleanup(setattr, _Transport, '_read_buffer', None)
+        _Transport._read_buffer = None
+        patcher = unittest.mock.patch.object(_Transport, 'BLOCK_SIZE', block)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+
+        # Keep the pipe full: there's always more than a block to read
+        refills = [b'b' * block, b'c' * block]
+        sizes = []
+
+        class RefillProtocol(Protocol):
+            def data_received(self, data):
+                super().data_received(data)
+                sizes.append(len(data))
+                if refills:
+                    os.write(write_fd, refills.pop(0))
+                elif len(sizes) == 3:
+                    os.close(write_fd)
+
+        os.write(write_fd, b'a' * 3 * block)
+        protocol = RefillProtocol()
+        PipeTransport(asyncio.get_running_loop(), protocol, read_fd, -1)
+        await asyncio.wait_for(protocol.lost.wait(), 5)
+
+        # never more than a block at once, with EOF after all of the data
+        self.assertEqual(sizes, [block] * 5)
+        self.assertEqual(protocol.data, b'a' * 3 * block + b'b' * block + b'c' * block)
+        self.assertEqual(protocol.events,
+                         ['connection_made'] + ['data_received'] * 5 + ['eof_received', 'connection_lost'])
+
+    async def test_pty_eof(self):
+        protocol = Protocol()
+        SubprocessTransport(asyncio.get_running_loop(), protocol, ['echo', 'hi'], True, None)
+        await asyncio.wait_for(protocol.lost.wait(), 5)
+        await asyncio.wait_for(protocol.exited.wait(), 5)
+
+        self.assertEqual(protocol.data, b'hi\r\n')
+        self.assertIn('eof_received', protocol.events)
+
+
+class TestSubprocessTransport(unittest.IsolatedAsyncioTestCase):
+    async def test_cat(self):
+        protocol = Protocol()
+        transport = SubprocessTransport(asyncio.get_running_loop(), protocol, ['cat'], False, None)
+        blob = os.urandom(3 * 1024 * 1024)
+        transport.write(blob)
+        transport.write_eof()
+        await asyncio.wait_for(protocol.lost.wait(), 10)
+        await asyncio.wait_for(protocol.exited.wait(), 5)
+
+        self.assertEqual(protocol.data, blob)
+        self.assertEqual(transport.get_returncode(), 0)
+
+    async def test_stderr(self):
+        protocol = Protocol()
+        transport = SubprocessTransport(asyncio.get_running_loop(), protocol,
+                                        ['sh', '-c', 'echo out; echo err >&2; exit 3'], False, None, stderr=-1)
+        await asyncio.wait_for(protocol.lost.wait(), 5)
+        await asyncio.wait_for(protocol.exited.wait(), 5)
+
+        self.assertEqual(protocol.data, b'out\n')
+        self.assertEqual(transport.get_stderr(), b'err\n')
+        self.assertEqual(transport.get_returncode(), 3)
+
+    async def test_no_pidfd(self):
+        self.addCleanup(setattr, SubprocessTransport, '_watcher', None)
+        SubprocessTransport._watcher = None
+
+        protocol = Protocol()
+        with unittest.mock.patch('os.pidfd_open', side_effect=OSError, create=True):
+            transport = SubprocessTransport(asyncio.get_running_loop(), protocol, ['true'], False, None)
+        await asyncio.wait_for(protocol.exited.wait(), 5)
+
+        self.assertEqual(protocol.events[0], 'connection_made')
+        self.assertEqual(transport.get_returncode(), 0)
+
+    async def test_no_pidfd_reaped_elsewhere(self):
+        self.addCleanup(setattr, SubprocessTransport, '_watcher', None)
+        SubprocessTransport._watcher = None
+
+        protocol = Protocol()
+        with unittest.mock.patch('os.pidfd_open', side_effect=OSError, create=True):
+            transport = SubprocessTransport(asyncio.get_running_loop(), protocol, ['sleep', '0.1'], False, None)
+
+        # let the watcher have its first look, then get there before it does
+        await asyncio.sleep(0.01)
+        with self.assertLogs('cockpit.transports', 'WARNING'):
+            os.waitpid(transport.get_pid(), 0)
+            await asyncio.wait_for(protocol.exited.wait(), 5)
+
+        self.assertEqual(transport.get_returncode(), 255)
+
+
+class TestSpooler(unittest.IsolatedAsyncioTestCase):
+    async def test_get(self):
+        read_fd, write_fd = os.pipe()
+        spooler = Spooler(asyncio.get_running_loop(), read_fd)
+        os.close(read_fd)
+
+        os.write(write_fd, b'abc')
+        self.assertEqual(spooler.get(), b'abc')
+        os.write(write_fd, b'def')
+        os.close(write_fd)
+        self.assertEqual(spooler.get(), b'abcdef')
+
+        # hitting EOF closes everything, but keeps the contents
+        self.assertEqual(spooler.get(), b'abcdef')
+        spooler.close()
+        self.assertEqual(spooler.get(), b'abcdef')
+
+    async def test_large(self):
+        read_fd, write_fd = os.pipe()
+        spooler = Spooler(asyncio.get_running_loop(), read_fd)
+        os.close(read_fd)
+
+        blob = os.urandom(1024 * 1024)
+        writer = asyncio.get_running_loop().run_in_executor(None, os.write, write_fd, blob)
+        self.assertEqual(await writer, len(blob))
+        os.close(write_fd)
+
+        self.assertEqual(spooler.get(), blob)
+        spooler.close()
+
+
+if __name__ == '__main__':
+    unittest.main()